@@ -2,13 +2,12 @@
 # Data preprocessing and aggregation
 # ----------------------------------------------------------------------------------------------------------------------
 
-from ligado import config as cfg
+from ligado import config as cfg, kernels
 from datetime import timedelta
 import numpy as np
 import pandas as pd
 from numpy import NaN
-from scipy.stats import ttest_1samp
-from typing import List
+from typing import List, Sequence
 
 def get_kpi_values_pivot(df_kpi_values: pd.DataFrame) -> pd.DataFrame:
     """
@@ -25,6 +24,102 @@ def filter_by_org_node(df: pd.DataFrame, org_node: pd.Series) -> pd.DataFrame:
     return df.loc[(df['orgNodeLeft'] >= org_node.left) & (df['orgNodeRight'] <= org_node.right)]
 
 
+def filter_by_kpi_filter(df_kpi: pd.DataFrame, kpi_filter: pd.Series) -> pd.DataFrame:
+    """
+    Returns a filtered kpi dataframe, see cfg.alert.filters.
+    """
+    if kpi_filter.type == 'nominal':
+        return df_kpi.loc[df_kpi[kpi_filter['variable']] == kpi_filter['value']]
+    elif kpi_filter.type == 'range':
+        return df_kpi.loc[(df_kpi[kpi_filter['variable']] >= kpi_filter['min']) &
+                          (df_kpi[kpi_filter['variable']] <= kpi_filter['max'])]
+    else:
+        return df_kpi
+
+
+def _get_period_starts(days: np.ndarray, timebin: str) -> np.ndarray:
+    """
+    Returns the first day of the day|week|month bin for integer day codes (days since 1970-01-01).
+    """
+    if timebin == 'week':
+        # 1970-01-01 is a thursday, weeks start on monday like pandas 'W' periods
+        return (days + 3) // 7 * 7 - 3
+    elif timebin == 'month':
+        # Convert only the distinct days to calendar months
+        unique_days, inverse = np.unique(days, return_inverse=True)
+        months = unique_days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[D]')
+        return months.astype(np.int64)[inverse]
+    else:
+        return days
+
+
+def get_kpi_aggregates_multi(df_kpi_values: pd.DataFrame, timebins: Sequence[str] = ('day', 'week', 'month'),
+                             org_nodes: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Returns a tidy dataframe containing the KPI mean, the number of item answers and the number of values for every
+    timebin. The kpi values are grouped once by KPI, day and org node, coarser timebins and parent org nodes are rolled
+    up from these partial sums. The input dataframe is not modified.
+
+    Parameters
+    ----------
+    df_kpi_values   : Dataframe with kpi data
+    timebins        : List of 'day'|'week'|'month'
+    org_nodes       : If set, aggregate for each of these org nodes and its children
+
+    Returns
+    -------
+    Dataframe indexed by timebin, [orgNodeID,] period (first day of the bin) and kpiName with columns mean, answers
+    and count. E.g. df.loc['week', 'mean'].unstack('kpiName') pivots the weekly means.
+    """
+    kpi_codes, kpi_names = pd.factorize(df_kpi_values['kpiName'])
+    values = df_kpi_values['value'].values.astype(np.float64)
+    is_valid = ~np.isnan(values)
+    columns = {
+        'kpi': kpi_codes,
+        'day': df_kpi_values.index.values.astype('datetime64[D]').astype(np.int64),
+        'sum': np.where(is_valid, values, 0),
+        'count': is_valid.astype(np.int64),
+        'answers': df_kpi_values['answers'].fillna(0).values,
+    }
+    node_keys = []
+    if org_nodes is not None:
+        columns['left'] = df_kpi_values['orgNodeLeft'].values
+        columns['right'] = df_kpi_values['orgNodeRight'].values
+        node_keys = ['left', 'right']
+
+    # Single grouped pass over the kpi values
+    df_partials = pd.DataFrame(columns).groupby(['kpi', 'day'] + node_keys, sort=False).sum().reset_index()
+
+    aggregates = []
+    for timebin in timebins:
+        df_binned = df_partials.assign(period=_get_period_starts(df_partials['day'].values, timebin)) \
+            .groupby(['kpi', 'period'] + node_keys, sort=False)[['sum', 'count', 'answers']].sum().reset_index()
+
+        if org_nodes is None:
+            df_binned['timebin'] = timebin
+            aggregates.append(df_binned)
+            continue
+
+        for node_id, node in org_nodes.iterrows():
+            df_node = filter_by_org_node(df_binned.rename(columns={'left': 'orgNodeLeft', 'right': 'orgNodeRight'}),
+                                         node)
+            df_node = df_node.groupby(['kpi', 'period'], sort=False)[['sum', 'count', 'answers']].sum().reset_index()
+            df_node['timebin'] = timebin
+            df_node['orgNodeID'] = node_id
+            aggregates.append(df_node)
+
+    df_aggregates = pd.concat(aggregates, ignore_index=True)
+    df_aggregates['kpiName'] = kpi_names[df_aggregates['kpi'].values]
+    df_aggregates['period'] = df_aggregates['period'].values.astype('datetime64[D]').astype('datetime64[ns]')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df_aggregates['mean'] = np.where(df_aggregates['count'] > 0, df_aggregates['sum'] / df_aggregates['count'],
+                                         NaN)
+
+    index = ['timebin'] + (['orgNodeID'] if org_nodes is not None else []) + ['period', 'kpiName']
+
+    return df_aggregates.set_index(index)[['mean', 'answers', 'count']].sort_index()
+
+
 def get_kpi_aggregates(df_kpi_values: pd.DataFrame, timebin: str, mean_only=False) -> pd.DataFrame:
     """
     Returns a dataframe containing the KPI mean and the number of item answer for every timebin
@@ -37,18 +132,12 @@ def get_kpi_aggregates(df_kpi_values: pd.DataFrame, timebin: str, mean_only=Fals
     """
     period_map = {'day': 'D', 'week': 'W', 'month': 'M'}
 
-    # Extract yyyy-mm from datetime index and assign to new column 'month'
-    df_kpi_values[timebin] = df_kpi_values.index.to_period(period_map[timebin])
-
-    # Aggregate the data by month and calculate the mean of the KPI values and the sum of item answers
-    aggregator = {'value': 'mean', 'answers': 'sum'}
-    df_kpi_binned = df_kpi_values.pivot_table(index=timebin, columns='kpiName', values=['value', 'answers'],
-                                              aggfunc=aggregator)
+    df_kpi_binned = get_kpi_aggregates_multi(df_kpi_values, [timebin]).loc[timebin, ['answers', 'mean']]
+    df_kpi_binned = df_kpi_binned.unstack('kpiName')
+    df_kpi_binned.index = df_kpi_binned.index.to_period(period_map[timebin]).rename(timebin)
 
     # Swap column levels so kpi name is on top of aggregation
     df_kpi_binned = df_kpi_binned.swaplevel(0, 1, axis='columns').sort_index(axis='columns')
-    # Rename aggregations
-    df_kpi_binned.rename({'value': 'mean'}, axis='columns', level=1, inplace=True)
     # Round float values
     df_kpi_binned = np.round(df_kpi_binned, 2)
 
@@ -132,45 +221,41 @@ def get_node_participation(df_surveys: pd.DataFrame, org_nodes: pd.DataFrame) ->
     return df_node_participation
 
 
-def get_kpi_timeline(df_node: pd.DataFrame, df_benchmarks: pd.DataFrame, kpi: pd.Series) -> pd.DataFrame:
+def get_kpi_timeline(df_node: pd.DataFrame, df_benchmarks: pd.DataFrame, kpi: pd.Series,
+                     kernel: str = None) -> pd.DataFrame:
     """
     Returns a kpi timeline dataframe containing moving average statistics.
+    kernel selects the window statistics kernel 'numpy'|'numba', defaults to cfg.stats.kernel, see ligado.kernels.
     """
     if df_node.empty:
         return pd.DataFrame()
 
-    timeline: List[dict] = []
-    period_interval = timedelta(days=cfg.stats.period_days)
     date_max = df_node.index.max()
     date_start = df_node.index.min()
 
     benchmark = df_benchmarks.loc[kpi['name']]
-    min_answers = cfg.stats.min_answers
-
-    # Date at the end of the shifitng time period and moved to previous monday
-    date = date_start - timedelta(days=date_start.weekday())
-    df_node_kpi = df_node.loc[df_node['kpiName'] == kpi['name']]
-    while date <= date_max:
-        period_mask = (df_node_kpi.index >= date - period_interval) & (df_node_kpi.index <= date)
-        df_period = df_node_kpi.loc[period_mask]
-        values = df_period['value']
-        n = len(values.index)
-        n_answers = df_period['answers'].sum()
-        mean = values.mean() if n >= min_answers else NaN
-
-        _, p_value = ttest_1samp(values, benchmark['mean']) if n >= min_answers else (NaN, NaN)
-
-        timeline.append({
-            'date': date,
-            'n': n,
-            'answers': n_answers,
-            'mean': round(mean, 2) if n >= min_answers else NaN,
-            'std': round(values.std(), 2) if n >= min_answers else NaN,
-            'z_score': round((mean - benchmark['mean']) / benchmark['std'], 2) if n >= min_answers else NaN,
-            'bm_z_score': 0,
-            'p_value': round(p_value, 5) if n >= min_answers else NaN,
-        })
-
-        date += timedelta(days=cfg.stats.step_days)
-
-    return pd.DataFrame(timeline).set_index('date')
+
+    # Dates at the end of the shifitng time period, starting at the previous monday
+    dates = pd.date_range(date_start - timedelta(days=date_start.weekday()), date_max,
+                          freq='{}D'.format(cfg.stats.step_days))
+    df_node_kpi = df_node.loc[df_node['kpiName'] == kpi['name']].sort_index(kind='mergesort')
+
+    window_stats = kernels.get_window_stats_kernel(kernel)
+    n, n_answers, mean, std, p_value = window_stats(
+        df_node_kpi.index.values.astype('datetime64[ns]').astype(np.int64),
+        df_node_kpi['value'].values.astype(np.float64),
+        df_node_kpi['answers'].values,
+        dates.values.astype('datetime64[ns]').astype(np.int64),
+        np.timedelta64(cfg.stats.period_days, 'D').astype('timedelta64[ns]').astype(np.int64),
+        benchmark['mean'],
+        cfg.stats.min_answers)
+
+    return pd.DataFrame({
+        'n': n,
+        'answers': n_answers,
+        'mean': np.round(mean, 2),
+        'std': np.round(std, 2),
+        'z_score': np.round((mean - benchmark['mean']) / benchmark['std'], 2),
+        'bm_z_score': 0,
+        'p_value': np.round(p_value, 5),
+    }, index=pd.DatetimeIndex(dates.values, name='date'))
@@ -5,27 +5,69 @@
 from ligado import config as cfg, aggregator
 import numpy as np
 import pandas as pd
+from datetime import timedelta
 from urllib.parse import quote
+import heapq
 import json
-from typing import List
+from typing import List, Tuple
 
-def _get_df_kpi_filtered(df_kpi: pd.DataFrame, kpi_filter: pd.Series) -> pd.DataFrame:
+_ALERT_COLUMNS = ['start', 'end', 'length', 'mean_answers', 'mean_z_score', 'min_p_value', 'node_id', 'node_label',
+                  'kpi', 'filter', 'url']
+
+def get_critical_segments(df_timelines: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
     """
-    Returns a filtered kpi dataframe
+    Returns the critical segments of many KPI timelines at once. A segment is a run of at least cfg.alert.min_datapoints
+    consecutive critical datapoints, i.e. significant z-scores within the yellow or red zone.
+
+    Parameters
+    ----------
+    df_timelines    : Long format timelines with key columns, date, n, z_score, p_value and polarity
+    keys            : Columns identifying a timeline, e.g. ['node_id', 'kpi', 'filter_id']
+
+    Returns
+    -------
+    Dataframe with the key columns and start, end, length, mean_answers, mean_z_score and min_p_value per segment.
     """
-    if kpi_filter.type == 'nominal':
-        return df_kpi.loc[df_kpi[kpi_filter['variable']] == kpi_filter['value']]
-    elif kpi_filter.type == 'range':
-        return df_kpi.loc[(df_kpi[kpi_filter['variable']] >= kpi_filter['min']) &
-                          (df_kpi[kpi_filter['variable']] <= kpi_filter['max'])]
-    else:
-        return df_kpi
+    df_timelines = df_timelines.sort_values(keys + ['date'], kind='mergesort')
+    z_scores = df_timelines['z_score'].values
+    p_values = df_timelines['p_value'].values
+
+    # z_score and p_value are NaN if there are not enough answers, NaN comparisons are false
+    critical = (z_scores * df_timelines['polarity'].values <= cfg.threshold.z_yellow) & \
+               (p_values <= cfg.threshold.p_value)
+
+    # Run-length encode the critical mask, runs must not span several timelines
+    timeline_ids = df_timelines.groupby(keys, sort=False).ngroup().values if keys else \
+        np.zeros(len(critical), dtype=np.int64)
+    is_first = np.concatenate(([True], (~critical[:-1]) | (timeline_ids[1:] != timeline_ids[:-1])))
+    run_starts = np.flatnonzero(critical & is_first)
+    run_ids = (np.cumsum(critical & is_first) - 1)[critical]
+    lengths = np.bincount(run_ids, minlength=len(run_starts))
+
+    # Runs are contiguous in the critical datapoints, so they start at the cumulated run lengths
+    run_offsets = np.cumsum(lengths) - lengths
+    min_p_values = np.minimum.reduceat(p_values[critical], run_offsets) if run_ids.size else np.empty(0)
+
+    segments = lengths >= cfg.alert.min_datapoints
+    starts = run_starts[segments]
+    lengths = lengths[segments]
+    dates = df_timelines['date'].values
+
+    df_segments = df_timelines.iloc[starts][keys].reset_index(drop=True)
+    df_segments['start'] = dates[starts]
+    df_segments['end'] = dates[starts + lengths - 1]
+    df_segments['length'] = lengths
+    df_segments['mean_answers'] = np.round(
+        np.bincount(run_ids, weights=df_timelines['n'].values[critical])[segments] / lengths, 1)
+    df_segments['mean_z_score'] = np.round(np.bincount(run_ids, weights=z_scores[critical])[segments] / lengths, 2)
+    df_segments['min_p_value'] = min_p_values[segments]
 
+    return df_segments
 
-def _add_alert(df_kpi_timeline: pd.DataFrame, alerts: List[dict], critical_dates: List[np.datetime64],
-               kpi_filter: pd.Series, node: pd.Series, kpi: pd.Series):
+
+def _get_alert(segment: pd.Series, kpi_filter: pd.Series, node: pd.Series, kpi: pd.Series) -> dict:
     """
-    Adds an alert to the list of alerts.
+    Returns an alert for a critical segment.
     """
 
     url_filters = {} if kpi_filter['type'] == 'none' else {
@@ -40,64 +82,225 @@ def _add_alert(df_kpi_timeline: pd.DataFrame, alerts: List[dict], critical_dates
     url = '{}/cockpit/index/orgNodeID/{}/kpiID/{}/filters/{}#kpiTimelines'.format(
         cfg.alert.base_url, node['nodeID'], kpi['kpiID'], quote(json.dumps(url_filters))
     )
-    alerts.append({
-        'start': critical_dates[0],
-        'end': critical_dates[-1],
-        'length': len(critical_dates),
-        'mean_answers': np.round(df_kpi_timeline.loc[critical_dates]['n'].mean(), 1),
+    return {
+        'start': segment['start'],
+        'end': segment['end'],
+        'length': segment['length'],
+        'mean_answers': segment['mean_answers'],
+        'mean_z_score': segment['mean_z_score'],
+        'min_p_value': segment['min_p_value'],
         'node_id': node['nodeID'],
         'node_label': node['label'],
         'kpi': kpi['label'],
         'filter': kpi_filter['description'],
         'url': url
-    })
+    }
 
 def _get_filter_alerts(df_kpi_timeline: pd.DataFrame, kpi_filter: pd.Series, node: pd.Series, kpi: pd.Series) -> List[dict]:
     """
-    Loops through a filtered KPI timeline (df_kpi_timeline) and returns a list of alerts. Alerts are critical segments
-    of the KPI timeline.
+    Returns a list of alerts for a filtered KPI timeline (df_kpi_timeline). Alerts are critical segments of the KPI
+    timeline.
     """
-    alerts: List[dict] = []
     if df_kpi_timeline.empty:
-        return alerts
-    # z_score is NaN if there are not enough answers
-    critical = (df_kpi_timeline['z_score'] is not np.NaN) & \
-               (df_kpi_timeline['z_score'] * kpi['polarity'] <= cfg.threshold.z_yellow) & \
-               (df_kpi_timeline['p_value'] <= cfg.threshold.p_value)
-
-    is_critical = False
-    critical_dates: List[np.datetime64] = []
-    for date, is_critical in critical.items():
-        if is_critical:
-            critical_dates.append(date)
-        else:
-            if len(critical_dates) >= cfg.alert.min_datapoints:
-                _add_alert(df_kpi_timeline, alerts, critical_dates, kpi_filter, node, kpi)
+        return []
 
-            critical_dates = []
+    df_segments = get_critical_segments(df_kpi_timeline.reset_index().assign(polarity=kpi['polarity']), [])
 
-    # Add (unterminated) alert at the end if critical
-    if is_critical and len(critical_dates) >= cfg.alert.min_datapoints:
-        _add_alert(df_kpi_timeline, alerts, critical_dates, kpi_filter, node, kpi)
-
-    return alerts
+    return [_get_alert(segment, kpi_filter, node, kpi) for _, segment in df_segments.iterrows()]
 
 
 def get_alerts(df_kpi_values: pd.DataFrame, org_nodes: pd.DataFrame, kpis: pd.DataFrame,
-               df_benchmarks: pd.DataFrame) -> pd.DataFrame:
-    alerts: List[dict] = []
+               df_benchmarks: pd.DataFrame, csv_path: str = 'output/alerts.csv') -> pd.DataFrame:
+    """
+    Returns all alerts of the given org nodes and KPIs and writes them to csv_path, unless csv_path is None.
+    """
+    timelines: List[pd.DataFrame] = []
 
     for node_id, node in org_nodes.iterrows():
-        for _, kpi in kpis.iterrows():
-            for _, kpi_filter in cfg.alert.filters.iterrows():
+        for kpi_name, kpi in kpis.iterrows():
+            for filter_id, kpi_filter in cfg.alert.filters.iterrows():
                 df_node = aggregator.filter_by_org_node(df_kpi_values, node)
-                df_filtered = _get_df_kpi_filtered(df_node, kpi_filter)
+                df_filtered = aggregator.filter_by_kpi_filter(df_node, kpi_filter)
                 df_kpi_timeline = aggregator.get_kpi_timeline(df_filtered, df_benchmarks, kpi)
+                if df_kpi_timeline.empty:
+                    continue
+
+                timelines.append(df_kpi_timeline.reset_index().assign(
+                    node_id=node_id, kpi_name=kpi_name, filter_id=filter_id, polarity=kpi['polarity']))
 
-                alerts += _get_filter_alerts(df_kpi_timeline, kpi_filter, node, kpi)
+    alerts: List[dict] = []
+    if timelines:
+        # Segment all timelines at once
+        df_segments = get_critical_segments(pd.concat(timelines, ignore_index=True),
+                                            ['node_id', 'kpi_name', 'filter_id'])
+        alerts = [_get_alert(segment, cfg.alert.filters.loc[segment['filter_id']], org_nodes.loc[segment['node_id']],
+                             kpis.loc[segment['kpi_name']]) for _, segment in df_segments.iterrows()]
 
-    df_alerts = pd.DataFrame(alerts).set_index('start').sort_index()
-    # df_alerts.to_excel('output/alerts.xlsx', index=False)
-    df_alerts.to_csv('output/alerts.csv', sep='\t', encoding='utf-8')
+    df_alerts = pd.DataFrame(alerts, columns=_ALERT_COLUMNS).set_index('start').sort_index()
+    if csv_path is not None:
+        # df_alerts.to_excel('output/alerts.xlsx', index=False)
+        df_alerts.to_csv(csv_path, sep='\t', encoding='utf-8')
 
     return df_alerts
+
+
+def _get_severity(alert: dict, kpi: pd.Series) -> float:
+    """
+    Returns the severity of an alert, i.e. the mean z-score deviation weighted by the segment length. Higher is worse.
+    """
+    return -alert['mean_z_score'] * kpi['polarity'] * alert['length']
+
+
+def _get_rank_key(alert: dict, rank_by: str) -> tuple:
+    """
+    Returns the ranking key of an alert, higher is worse. The p-value ranking breaks ties by severity, since p-values
+    are rounded and often 0.
+    """
+    if rank_by == 'p_value':
+        return -alert['min_p_value'], alert['severity']
+
+    return alert['severity'],
+
+
+def _get_severity_bound(df_kpi: pd.DataFrame, kpi: pd.Series, benchmark: pd.Series, date_start, date_max,
+                        date_min) -> float:
+    """
+    Returns an upper bound for the z-score x length severity of the critical segments in a KPI timeline, or NaN if the
+    timeline cannot contain a critical segment. date_start and date_max must be the first and last date of the data
+    used by aggregator.get_kpi_timeline, so the windows are the same.
+
+    The moving average z-scores are computed from cumulated daily answer counts and value sums only. The p-value
+    condition is ignored, which can only shorten or split critical segments and therefore never raises the severity.
+    The kernels of aggregator.get_kpi_timeline use different float arithmetic, so their rounded z-scores may differ by
+    0.01 from these. Each datapoint is therefore given 0.01 slack, both for being critical and for its deviation.
+    """
+    df_daily = df_kpi['value'].groupby(level=0).agg(['sum', 'count', 'size'])
+    days = df_daily.index.values
+    sums = np.concatenate(([0], df_daily['sum'].cumsum().values))
+    counts = np.concatenate(([0], df_daily['count'].cumsum().values))
+    sizes = np.concatenate(([0], df_daily['size'].cumsum().values))
+
+    dates = pd.date_range(date_start - timedelta(days=date_start.weekday()), date_max,
+                          freq='{}D'.format(cfg.stats.step_days)).values
+    if date_min is not None:
+        dates = dates[dates >= np.datetime64(date_min)]
+
+    upper = np.searchsorted(days, dates, side='right')
+    lower = np.searchsorted(days, dates - np.timedelta64(cfg.stats.period_days, 'D'), side='left')
+    # Like the timeline, the number of answers includes NaN values, the mean skips them
+    n = sizes[upper] - sizes[lower]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_score = np.round(((sums[upper] - sums[lower]) / (counts[upper] - counts[lower]) - benchmark['mean']) /
+                           benchmark['std'], 2)
+
+    deviation = np.where((n >= cfg.stats.min_answers) & ~np.isnan(z_score), -z_score * kpi['polarity'] + 0.01, 0)
+    critical = deviation >= -cfg.threshold.z_yellow
+
+    # Sum up deviations over runs of consecutive critical datapoints
+    run_ids = np.cumsum(~critical)[critical]
+    if run_ids.size == 0:
+        return np.NaN
+
+    run_lengths = np.bincount(run_ids)
+    run_deviations = np.bincount(run_ids, weights=deviation[critical])
+    valid = run_lengths >= cfg.alert.min_datapoints
+    if not valid.any():
+        return np.NaN
+
+    # Allow for rounding the mean z-score of a segment
+    return (run_deviations[valid] + 0.005 * run_lengths[valid]).max()
+
+
+def _get_top_alert_candidates(df_kpi_values: pd.DataFrame, org_nodes: pd.DataFrame, kpis: pd.DataFrame,
+                              df_benchmarks: pd.DataFrame, date_min) -> List[Tuple[float, int, str, int]]:
+    """
+    Returns (severity upper bound, node id, kpi name, filter index) tuples for all combinations which may contain a
+    critical segment, sorted by descending upper bound.
+    """
+    candidates: List[Tuple[float, int, str, int]] = []
+    for node_id, node in org_nodes.iterrows():
+        df_node = aggregator.filter_by_org_node(df_kpi_values, node)
+        for filter_id, kpi_filter in cfg.alert.filters.iterrows():
+            df_filtered = aggregator.filter_by_kpi_filter(df_node, kpi_filter)
+            if df_filtered.empty:
+                continue
+
+            # The timeline dates depend on all KPIs of the filtered data
+            date_start = df_filtered.index.min()
+            date_max = df_filtered.index.max()
+            for kpi_name, df_kpi in df_filtered.loc[df_filtered['kpiName'].isin(kpis.index)].groupby('kpiName'):
+                bound = _get_severity_bound(df_kpi, kpis.loc[kpi_name], df_benchmarks.loc[kpi_name], date_start,
+                                            date_max, date_min)
+                if not np.isnan(bound):
+                    candidates.append((bound, node_id, kpi_name, filter_id))
+
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+    return candidates
+
+
+def get_top_alerts(df_kpi_values: pd.DataFrame, org_nodes: pd.DataFrame, kpis: pd.DataFrame,
+                   df_benchmarks: pd.DataFrame, k: int = None, rank_by: str = 'z_score',
+                   weeks: int = None) -> pd.DataFrame:
+    """
+    Returns the k most severe alerts, ranked by severity (mean z-score x length) or by p-value. Ties of the rounded
+    p-values are broken by severity.
+    Combinations of org node, KPI and filter which cannot enter the top k are skipped without computing their timeline,
+    using cheap severity bounds from daily answer counts and means. For the p-value ranking, the bounds only apply
+    once the top k alerts all have a p-value of 0.
+
+    Parameters
+    ----------
+    df_kpi_values   : Dataframe with kpi data
+    org_nodes       : Org nodes to scan
+    kpis            : KPIs to scan
+    df_benchmarks   : KPI benchmarks
+    k               : Number of alerts to return, defaults to cfg.alert.top_k
+    rank_by         : string 'z_score'|'p_value'
+    weeks           : If set, only consider timeline datapoints within the latest number of weeks
+    """
+    if rank_by not in ('z_score', 'p_value'):
+        raise ValueError("rank_by must be 'z_score' or 'p_value', got '{}'".format(rank_by))
+
+    k = cfg.alert.top_k if k is None else k
+    if k < 1:
+        raise ValueError('k must be at least 1, got {}'.format(k))
+
+    date_min = None
+    if weeks is not None:
+        date_min = df_kpi_values.index.max() - timedelta(weeks=weeks)
+        # Keep a full moving average period before the first datapoint
+        df_kpi_values = df_kpi_values.loc[df_kpi_values.index >= date_min - timedelta(days=cfg.stats.period_days)]
+
+    # Min-heap of (rank key, sequence, alert), the root is the least severe alert of the current top k
+    top: List[Tuple[tuple, int, dict]] = []
+    sequence = 0
+    candidates = _get_top_alert_candidates(df_kpi_values, org_nodes, kpis, df_benchmarks, date_min)
+    for bound, node_id, kpi_name, filter_id in candidates:
+        # Candidates are sorted by bound, so none of the remaining ones can enter the top k.
+        # The best possible p-value is 0.
+        max_key = (0, bound) if rank_by == 'p_value' else (bound,)
+        if len(top) >= k and max_key <= top[0][0]:
+            break
+
+        node = org_nodes.loc[node_id]
+        kpi = kpis.loc[kpi_name]
+        kpi_filter = cfg.alert.filters.loc[filter_id]
+        df_node = aggregator.filter_by_org_node(df_kpi_values, node)
+        df_filtered = aggregator.filter_by_kpi_filter(df_node, kpi_filter)
+        df_kpi_timeline = aggregator.get_kpi_timeline(df_filtered, df_benchmarks, kpi)
+        if date_min is not None and not df_kpi_timeline.empty:
+            df_kpi_timeline = df_kpi_timeline.loc[df_kpi_timeline.index >= date_min]
+
+        for alert in _get_filter_alerts(df_kpi_timeline, kpi_filter, node, kpi):
+            alert['severity'] = np.round(_get_severity(alert, kpi), 5)
+            key = _get_rank_key(alert, rank_by)
+            sequence += 1
+            if len(top) < k:
+                heapq.heappush(top, (key, sequence, alert))
+            elif key > top[0][0]:
+                heapq.heapreplace(top, (key, sequence, alert))
+
+    alerts = [alert for _, _, alert in sorted(top, key=lambda entry: ([-value for value in entry[0]], entry[1]))]
+
+    return pd.DataFrame(alerts, columns=_ALERT_COLUMNS + ['severity'])
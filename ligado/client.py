@@ -0,0 +1,57 @@
+# ----------------------------------------------------------------------------------------------------------------------
+# Client for the local analysis server, see ligado.server
+# ----------------------------------------------------------------------------------------------------------------------
+
+from ligado import config as cfg
+from io import StringIO
+from urllib.parse import urlencode
+from urllib.request import urlopen
+import pandas as pd
+from typing import List
+
+
+def _get_df(path: str, params: dict) -> pd.DataFrame:
+    """
+    Requests a dataframe from the analysis server. Parameters with value None are omitted.
+    """
+    query = urlencode({name: value for name, value in params.items() if value is not None})
+    url = 'http://{}:{}{}?{}'.format(cfg.server.host, cfg.server.port, path, query)
+    with urlopen(url) as response:
+        df = pd.read_json(StringIO(response.read().decode('utf-8')), orient='table')
+        index_columns = response.headers.get('X-Index-Columns')
+
+    return df.set_index(index_columns.split(',')) if index_columns else df
+
+
+def _join(items: List) -> str:
+    return None if items is None else ','.join(str(item) for item in items)
+
+
+def get_kpi_timeline(node_id: int, kpi_name: str, filter_id: int = 0) -> pd.DataFrame:
+    """
+    Returns a kpi timeline like aggregator.get_kpi_timeline. filter_id is the index of cfg.alert.filters.
+    """
+    return _get_df('/timeline', {'node': node_id, 'kpi': kpi_name, 'filter': filter_id})
+
+
+def get_participation_timelines(node_id: int) -> pd.DataFrame:
+    """
+    Returns participation timelines like aggregator.get_participation_timelines.
+    """
+    return _get_df('/participation', {'node': node_id})
+
+
+def get_alerts(node_ids: List[int] = None, kpi_names: List[str] = None) -> pd.DataFrame:
+    """
+    Returns alerts like alert.get_alerts, by default for cfg.nodes.selected and all KPIs with benchmarks.
+    """
+    return _get_df('/alerts', {'nodes': _join(node_ids), 'kpis': _join(kpi_names)})
+
+
+def get_top_alerts(node_ids: List[int] = None, kpi_names: List[str] = None, k: int = None,
+                   rank_by: str = None, weeks: int = None) -> pd.DataFrame:
+    """
+    Returns the k most severe alerts like alert.get_top_alerts.
+    """
+    return _get_df('/top_alerts', {'nodes': _join(node_ids), 'kpis': _join(kpi_names), 'k': k,
+                                   'rank_by': rank_by, 'weeks': weeks})
@@ -46,6 +46,9 @@ class stats:
     # Time window length in days for moving average
     period_days = 30
 
+    # Kernel for moving window statistics, 'numpy' or 'numba' (falls back to 'numpy' if numba is not installed)
+    kernel = 'numba'
+
 class threshold:
     # Mark p-values as significant if below
     p_value = 0.05
@@ -66,6 +69,9 @@ class alert:
     # Minimual number of consecutive critical datapoints for alert
     min_datapoints = 3
 
+    # Number of alerts returned by alert.get_top_alerts
+    top_k = 20
+
     # For adding links to the cockpit, e.g. 'https://sbb.ligado.ch'
     base_url: str
 
@@ -90,3 +96,15 @@ class alert:
         {'type': 'range', 'plugin': 'EmploymentDurationFilter', 'category': 'group3',
          'variable': 'employment', 'min': 3, 'max': 100, 'description': 'Employment duration: more than 3 years'},
     ])
+
+class store:
+    # SQLite file with precomputed timelines, see store.export_timelines
+    path = 'output/timelines.sqlite'
+
+class server:
+    # Address of the local analysis server, see server.serve and client
+    host = '127.0.0.1'
+    port = 8765
+
+    # Interval for reloading the data in the background
+    refresh_minutes = 60
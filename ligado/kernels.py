@@ -0,0 +1,228 @@
+# ----------------------------------------------------------------------------------------------------------------------
+# Moving window statistics kernels
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Kernels for the moving average statistics of aggregator.get_kpi_timeline. The NumPy kernel uses cumulated sums, the
+# optional Numba kernel (conda install numba) moves running sums over contiguous arrays without allocating per window.
+# The kernel is selected with cfg.stats.kernel, falling back to NumPy if Numba is not installed.
+
+from ligado import config as cfg
+from math import exp, lgamma, log, sqrt
+import time
+import numpy as np
+from numpy import NaN
+from scipy.special import stdtr
+from typing import Callable, Tuple
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _jit(function: Callable) -> Callable:
+    """
+    Compiles a function with Numba if installed, returns the pure Python function otherwise.
+    """
+    return numba.njit(cache=True)(function) if numba is not None else function
+
+
+def _window_stats_numpy(times: np.ndarray, values: np.ndarray, answers: np.ndarray, dates: np.ndarray, period: int,
+                        bm_mean: float, min_answers: int) -> Tuple[np.ndarray, ...]:
+    upper = np.searchsorted(times, dates, side='right')
+    lower = np.searchsorted(times, dates - period, side='left')
+    n = upper - lower
+
+    # Skip NaN values like pandas, n keeps counting all datapoints
+    is_valid = ~np.isnan(values)
+    valid_counts = np.concatenate(([0], np.cumsum(is_valid)))
+    n_valid = valid_counts[upper] - valid_counts[lower]
+
+    # Cumulate deviations from the benchmark instead of raw values to limit cancellation in the variance
+    deviations = np.where(is_valid, values - bm_mean, 0)
+    sums = np.concatenate(([0.0], np.cumsum(deviations)))
+    squares = np.concatenate(([0.0], np.cumsum(deviations * deviations)))
+    answers = np.nan_to_num(answers)
+    answer_sums = np.concatenate((np.zeros(1, dtype=answers.dtype), np.cumsum(answers)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_deviation = (sums[upper] - sums[lower]) / n_valid
+        variance = (squares[upper] - squares[lower] - n_valid * mean_deviation * mean_deviation) / (n_valid - 1)
+        std = np.where(n_valid >= 2, np.sqrt(np.maximum(variance, 0)), NaN)
+        # Two-sided p-value of the one-sample t-test against the benchmark mean
+        p_value = 2 * stdtr(n_valid - 1, -np.abs(mean_deviation / (std / np.sqrt(n_valid))))
+
+    enough = n >= min_answers
+
+    return n, answer_sums[upper] - answer_sums[lower], np.where(enough, bm_mean + mean_deviation, NaN), \
+        np.where(enough, std, NaN), np.where(enough, p_value, NaN)
+
+
+@_jit
+def _betacf(a: float, b: float, x: float) -> float:
+    """
+    Continued fraction for the incomplete beta function (modified Lentz's method).
+    """
+    tiny = 1e-300
+    c = 1.0
+    d = 1.0 - (a + b) * x / (a + 1.0)
+    d = 1.0 / (d if abs(d) > tiny else tiny)
+    h = d
+    for m in range(1, 300):
+        m2 = 2 * m
+        aa = m * (b - m) * x / ((a + m2 - 1.0) * (a + m2))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + aa / c
+        c = c if abs(c) > tiny else tiny
+        h *= d * c
+        aa = -(a + m) * (a + b + m) * x / ((a + m2) * (a + m2 + 1.0))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + aa / c
+        c = c if abs(c) > tiny else tiny
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < 1e-15:
+            break
+
+    return h
+
+
+@_jit
+def _betainc(a: float, b: float, x: float) -> float:
+    """
+    Regularized incomplete beta function.
+    """
+    if x <= 0.0:
+        return 0.0
+    if x >= 1.0:
+        return 1.0
+
+    front = exp(lgamma(a + b) - lgamma(a) - lgamma(b) + a * log(x) + b * log(1.0 - x))
+    if x < (a + 1.0) / (a + b + 2.0):
+        return front * _betacf(a, b, x) / a
+
+    return 1.0 - front * _betacf(b, a, 1.0 - x) / b
+
+
+@_jit
+def _window_stats_loop(times, values, answers, dates, period, bm_mean, min_answers,
+                       n_out, answers_out, mean_out, std_out, p_out):
+    lower = 0
+    upper = 0
+    # Running sums over the current window, deviations from the benchmark limit cancellation like the NumPy kernel.
+    # NaN values and answers are skipped like in pandas, n keeps counting all datapoints.
+    n_valid = 0
+    total = 0.0
+    squares = 0.0
+    n_answers = 0
+    for i in range(dates.shape[0]):
+        # Dates are ascending, so both window boundaries only move forward
+        while upper < times.shape[0] and times[upper] <= dates[i]:
+            if not np.isnan(values[upper]):
+                deviation = values[upper] - bm_mean
+                n_valid += 1
+                total += deviation
+                squares += deviation * deviation
+            if not np.isnan(answers[upper]):
+                n_answers += answers[upper]
+            upper += 1
+        while lower < upper and times[lower] < dates[i] - period:
+            if not np.isnan(values[lower]):
+                deviation = values[lower] - bm_mean
+                n_valid -= 1
+                total -= deviation
+                squares -= deviation * deviation
+            if not np.isnan(answers[lower]):
+                n_answers -= answers[lower]
+            lower += 1
+
+        n = upper - lower
+        n_out[i] = n
+        answers_out[i] = n_answers
+        if n_valid == 0:
+            # Reset to avoid drift of the running sums
+            total = 0.0
+            squares = 0.0
+
+        if n < min_answers or n_valid == 0:
+            mean_out[i] = NaN
+            std_out[i] = NaN
+            p_out[i] = NaN
+            continue
+
+        mean_deviation = total / n_valid
+        mean_out[i] = bm_mean + mean_deviation
+        if n_valid < 2:
+            std_out[i] = NaN
+            p_out[i] = NaN
+            continue
+
+        std = sqrt(max(squares - n_valid * mean_deviation * mean_deviation, 0.0) / (n_valid - 1))
+        std_out[i] = std
+
+        # Two-sided p-value of the one-sample t-test, I_x(df / 2, 1 / 2) with x = df / (df + t^2)
+        if std == 0.0:
+            p_out[i] = NaN if mean_deviation == 0.0 else 0.0
+        else:
+            t = mean_deviation / (std / sqrt(n_valid))
+            df = n_valid - 1.0
+            p_out[i] = _betainc(df / 2.0, 0.5, df / (df + t * t))
+
+
+def _window_stats_numba(times: np.ndarray, values: np.ndarray, answers: np.ndarray, dates: np.ndarray, period: int,
+                        bm_mean: float, min_answers: int) -> Tuple[np.ndarray, ...]:
+    size = dates.shape[0]
+    n = np.zeros(size, dtype=np.int64)
+    n_answers = np.zeros(size, dtype=answers.dtype)
+    mean = np.empty(size)
+    std = np.empty(size)
+    p_value = np.empty(size)
+    _window_stats_loop(np.ascontiguousarray(times), np.ascontiguousarray(values, dtype=np.float64),
+                       np.ascontiguousarray(answers), np.ascontiguousarray(dates), period, bm_mean, min_answers,
+                       n, n_answers, mean, std, p_value)
+
+    return n, n_answers, mean, std, p_value
+
+
+_kernels = {'numpy': _window_stats_numpy, 'numba': _window_stats_numba}
+
+
+def get_window_stats_kernel(kernel: str = None) -> Callable[..., Tuple[np.ndarray, ...]]:
+    """
+    Returns the window statistics kernel 'numpy'|'numba', defaults to cfg.stats.kernel. Falls back to the NumPy kernel
+    if Numba is not installed.
+
+    The kernel takes the sorted datapoint times, values and answers, the ascending window end dates (times and dates
+    as int64 nanoseconds), the window period in nanoseconds, the benchmark mean and cfg.stats.min_answers. It returns
+    n, answers, mean, std and p-value arrays per window, mean, std and p-value are NaN below min_answers.
+    """
+    kernel = cfg.stats.kernel if kernel is None else kernel
+    if kernel not in _kernels:
+        raise ValueError("kernel must be 'numpy' or 'numba', got '{}'".format(kernel))
+    if kernel == 'numba' and numba is None:
+        kernel = 'numpy'
+
+    return _kernels[kernel]
+
+
+def compare_kernels(times: np.ndarray, values: np.ndarray, answers: np.ndarray, dates: np.ndarray, period: int,
+                    bm_mean: float, min_answers: int, repeat: int = 10) -> dict:
+    """
+    Checks that the NumPy and the Numba kernel return the same statistics and returns their mean run time in seconds.
+    The Numba kernel is compiled before timing. Without Numba, its pure Python fallback is compared.
+    """
+    results = {}
+    durations = {}
+    for kernel, window_stats in _kernels.items():
+        results[kernel] = window_stats(times, values, answers, dates, period, bm_mean, min_answers)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            window_stats(times, values, answers, dates, period, bm_mean, min_answers)
+        durations[kernel] = (time.perf_counter() - start) / repeat
+
+    for expected, actual in zip(results['numpy'], results['numba']):
+        np.testing.assert_allclose(actual, expected, rtol=1e-7, atol=1e-9, equal_nan=True)
+
+    return durations
@@ -8,8 +8,17 @@ import pandas as pd
 from dotenv import load_dotenv  # conda install -c conda-forge python-dotenv
 from sshtunnel import SSHTunnelForwarder  # conda install -c conda-forge sshtunnel
 from pathlib import Path
+from contextlib import contextmanager
+import threading
+
+# Connection and csv export settings of the current db_session, per thread
+_session = threading.local()
+
 
 def _get_db_connection():
+    """
+    Returns a (connection, tunnel) tuple, tunnel is None for the local DB.
+    """
     load_dotenv(Path('.') / '.env')
     if cfg.data.source == DataSource.REMOTE_DB:
         tunnel = SSHTunnelForwarder(
@@ -19,12 +28,66 @@ def _get_db_connection():
             remote_bind_address=(os.getenv('REM_BIND_HOST'), int(os.getenv('REM_BIND_PORT')))
         )
         tunnel.start()
-        return sql.connect(host=os.getenv('REM_DB_HOST'), port=tunnel.local_bind_port,
-                           database=os.getenv('REM_DB_NAME'), user=os.getenv('REM_DB_USERNAME'))
+        try:
+            return sql.connect(host=os.getenv('REM_DB_HOST'), port=tunnel.local_bind_port,
+                               database=os.getenv('REM_DB_NAME'), user=os.getenv('REM_DB_USERNAME')), tunnel
+        except Exception:
+            tunnel.stop()
+            raise
 
     else:
         return sql.connect(host=os.getenv('DB_HOST'), port=os.getenv('DB_PORT'), database=os.getenv('DB_NAME'),
-                           user=os.getenv('DB_USERNAME'), password=os.getenv('DB_PASSWORD'))
+                           user=os.getenv('DB_USERNAME'), password=os.getenv('DB_PASSWORD')), None
+
+
+def _close_db_connection(db_connection, tunnel):
+    db_connection.close()
+    if tunnel is not None:
+        tunnel.stop()
+
+
+@contextmanager
+def db_session(export_csv: bool = True):
+    """
+    Reuses a single DB connection (and SSH tunnel) for all get_df_* calls within the block and closes it afterwards.
+    The connection is only opened if a table is read from the DB.
+
+    Parameters
+    ----------
+    export_csv  : If false, tables read from the DB are not written to output/import-*.csv
+    """
+    _session.active = True
+    _session.connection = None
+    _session.export_csv = export_csv
+    try:
+        yield
+    finally:
+        if _session.connection is not None:
+            _close_db_connection(*_session.connection)
+        _session.active = False
+        _session.connection = None
+        _session.export_csv = True
+
+
+def _read_sql(query: str, **kwargs) -> pd.DataFrame:
+    """
+    Reads a query result, using the connection of the current db_session if any.
+    """
+    if getattr(_session, 'active', False):
+        if _session.connection is None:
+            _session.connection = _get_db_connection()
+        return pd.read_sql(query, _session.connection[0], **kwargs)
+
+    db_connection, tunnel = _get_db_connection()
+    try:
+        return pd.read_sql(query, db_connection, **kwargs)
+    finally:
+        _close_db_connection(db_connection, tunnel)
+
+
+def _export_csv(df: pd.DataFrame, path: str, **kwargs):
+    if getattr(_session, 'export_csv', True):
+        df.to_csv(path, sep='\t', encoding='utf-8', **kwargs)
 
 
 def get_df_kpis() -> pd.DataFrame:
@@ -34,10 +97,8 @@ def get_df_kpis() -> pd.DataFrame:
             FROM survey_itemsets AS i
             LEFT JOIN texts AS t ON i.labelTextID = t.textID
             WHERE i.labelTextID IS NOT NULL AND i.exportName IS NOT NULL"""
-        db_connection = _get_db_connection()
-        df_kpis = pd.read_sql(query, db_connection)
-        db_connection.close()
-        df_kpis.to_csv('output/import-kpis.csv', sep='\t', encoding='utf-8', index=False)
+        df_kpis = _read_sql(query)
+        _export_csv(df_kpis, 'output/import-kpis.csv', index=False)
     else:
         df_kpis = pd.read_csv('data/import-kpis.csv', delimiter='\t')
 
@@ -70,11 +131,8 @@ def get_df_kpi_values() -> pd.DataFrame:
             LEFT JOIN survey_itemsets AS i USING (itemsetID)
             LEFT JOIN org_nodes AS o ON us.orgNodeID = o.nodeID
             WHERE u.roleID = 2 AND us.surveyID = {}""".format(cfg.data.ligado_survey_id)
-        db_connection = _get_db_connection()
-        df_kpi_values = pd.read_sql(query, db_connection, parse_dates=['dateStart', 'dateCompleted'],
-                                    index_col='dateCompleted')
-        db_connection.close()
-        df_kpi_values.to_csv('output/import-kpi-values.csv', sep='\t', encoding='utf-8')
+        df_kpi_values = _read_sql(query, parse_dates=['dateStart', 'dateCompleted'], index_col='dateCompleted')
+        _export_csv(df_kpi_values, 'output/import-kpi-values.csv')
     else:
         df_kpi_values = pd.read_csv('data/import-kpi-values.csv', delimiter='\t',
                                     parse_dates=['dateStart', 'dateCompleted'], index_col='dateCompleted')
@@ -92,10 +150,8 @@ def get_df_org_nodes() -> pd.DataFrame:
             ) AS sub ON sub.`left` >= o.`left` AND sub.`right` <= o.`right`
             GROUP BY o.nodeID
             ORDER BY o.`level`, o.parentNodeID, o.nodeID """
-        db_connection = _get_db_connection()
-        df_org_nodes = pd.read_sql(query, db_connection, coerce_float=False)
-        db_connection.close()
-        df_org_nodes.to_csv('output/import-org-nodes.csv', sep='\t', encoding='utf-8', index=False)
+        df_org_nodes = _read_sql(query, coerce_float=False)
+        _export_csv(df_org_nodes, 'output/import-org-nodes.csv', index=False)
     else:
         df_org_nodes = pd.read_csv('data/import-org-nodes.csv', delimiter='\t')
 
@@ -114,10 +170,8 @@ def get_df_participants() -> pd.DataFrame:
             LEFT JOIN user_surveys AS us ON u.userID = us.userID
             WHERE u.roleID = 2 AND us.surveyID = {}
             GROUP BY u.userID""".format(cfg.data.ligado_survey_id)
-        db_connection = _get_db_connection()
-        df_participants = pd.read_sql(query, db_connection, index_col='importKey')
-        db_connection.close()
-        df_participants.to_csv('output/import-participation.csv', sep='\t', encoding='utf-8')
+        df_participants = _read_sql(query, index_col='importKey')
+        _export_csv(df_participants, 'output/import-participation.csv')
     else:
         df_participants = pd.read_csv('data/import-participation.csv', delimiter='\t', index_col='importKey')
 
@@ -142,11 +196,8 @@ def get_df_surveys() -> pd.DataFrame:
             LEFT JOIN mobile_connections AS mc ON mc.userID = u.userID
             WHERE u.roleID = 2 AND us.surveyID = {}
             GROUP BY us.userSurveyID""".format(cfg.data.ligado_survey_id)
-        db_connection = _get_db_connection()
-        df_surveys = pd.read_sql(query, db_connection, index_col='userSurveyID',
-                                 parse_dates=['dateStart', 'dateCompleted'])
-        db_connection.close()
-        df_surveys.to_csv('output/import-surveys.csv', sep='\t', encoding='utf-8')
+        df_surveys = _read_sql(query, index_col='userSurveyID', parse_dates=['dateStart', 'dateCompleted'])
+        _export_csv(df_surveys, 'output/import-surveys.csv')
     else:
         df_surveys = pd.read_csv('data/import-surveys.csv', delimiter='\t', index_col='userSurveyID',
                                  parse_dates=['dateStart', 'dateCompleted'])
@@ -164,10 +215,8 @@ def get_df_users() -> pd.DataFrame:
             LEFT JOIN mobile_connections AS mc ON mc.userID = u.userID
             WHERE u.roleID = 2
             GROUP BY u.userID"""
-        db_connection = _get_db_connection()
-        df_users = pd.read_sql(query, db_connection, index_col='userID')
-        db_connection.close()
-        df_users.to_csv('output/import-users.csv', sep='\t', encoding='utf-8')
+        df_users = _read_sql(query, index_col='userID')
+        _export_csv(df_users, 'output/import-users.csv')
     else:
         df_users = pd.read_csv('data/import-users.csv', delimiter='\t', index_col='userID')
 
@@ -0,0 +1,192 @@
+# ----------------------------------------------------------------------------------------------------------------------
+# Local analysis server
+# ----------------------------------------------------------------------------------------------------------------------
+
+# Loads the ligado tables once, keeps them in memory and answers timeline, participation and alert requests over a
+# local HTTP API, see ligado.client. Configure cfg like in a project notebook, change into the project directory and
+# call serve(). Data is reloaded in the background every cfg.server.refresh_minutes.
+#
+# Endpoints (GET, JSON in pandas 'table' format without index, the X-Index-Columns header names the index columns):
+#   /timeline?node=<nodeID>&kpi=<kpi name>[&filter=<index of cfg.alert.filters>]
+#   /participation?node=<nodeID>
+#   /alerts[?nodes=<nodeID>,...][&kpis=<kpi name>,...]
+#   /top_alerts[?nodes=...][&kpis=...][&k=20][&rank_by=z_score|p_value][&weeks=<n>]
+
+from ligado import config as cfg, reader, aggregator, alert
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import json
+import logging
+import threading
+import pandas as pd
+from typing import Callable, Dict, Tuple
+
+_logger = logging.getLogger(__name__)
+
+
+def get_measured_benchmarks(df_kpis: pd.DataFrame, df_kpi_values: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns KPI benchmarks measured from the kpi values.
+    """
+    aggregated = df_kpi_values.groupby('kpiName')['value'].agg(['mean', 'std', 'count']).round(2)
+    df_benchmarks = df_kpis.join(aggregated)
+    df_benchmarks['comment'] = 'Measured'
+
+    return df_benchmarks
+
+
+class _Data:
+    """
+    Snapshot of the ligado tables and the results derived from them. Results are cached until the next refresh.
+    """
+
+    def __init__(self, df_benchmarks: pd.DataFrame = None):
+        # One DB connection and SSH tunnel per snapshot, the import csv files are left to the notebooks
+        with reader.db_session(export_csv=False):
+            self.df_kpis = reader.get_df_kpis()
+            self.df_kpi_values = reader.get_df_kpi_values()
+            self.df_org_nodes = reader.get_df_org_nodes()
+            self.df_surveys = reader.get_df_surveys()
+        self.df_benchmarks = get_measured_benchmarks(self.df_kpis, self.df_kpi_values) \
+            if df_benchmarks is None else df_benchmarks
+
+        self.cache: Dict[tuple, Tuple[str, str]] = {}
+        self.lock = threading.Lock()
+
+    def get_cached(self, key: tuple, compute: Callable[[], pd.DataFrame]) -> Tuple[str, str]:
+        """
+        Returns the JSON of a computed dataframe and its comma separated index columns.
+        The index is sent as columns, since pandas drops it from the 'table' format if it is not unique.
+        """
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+
+        df = compute()
+        index_columns = [name for name in df.index.names if name is not None]
+        if index_columns:
+            df = df.reset_index()
+        result = df.to_json(orient='table', date_format='iso', index=False), ','.join(index_columns)
+        with self.lock:
+            self.cache[key] = result
+
+        return result
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    server: '_AnalysisServer'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        routes = {
+            '/timeline': self._get_timeline,
+            '/participation': self._get_participation,
+            '/alerts': self._get_alerts,
+            '/top_alerts': self._get_top_alerts,
+        }
+        if url.path not in routes:
+            self._send(404, json.dumps({'error': 'Unknown path {}'.format(url.path)}))
+            return
+
+        try:
+            body, index_columns = routes[url.path](self.server.data, params)
+            self._send(200, body, index_columns)
+        except (KeyError, ValueError) as e:
+            self._send(400, json.dumps({'error': '{}: {}'.format(type(e).__name__, e)}))
+        except Exception as e:
+            _logger.exception('Request %s failed', self.path)
+            self._send(500, json.dumps({'error': '{}: {}'.format(type(e).__name__, e)}))
+
+    def _send(self, status: int, body: str, index_columns: str = ''):
+        content = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Index-Columns', index_columns)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # Keep notebooks and job logs quiet
+        pass
+
+    @staticmethod
+    def _get_list(params: dict, name: str, default: list, item_type=str) -> list:
+        return [item_type(item) for item in params[name].split(',')] if name in params else default
+
+    def _get_timeline(self, data: _Data, params: dict) -> Tuple[str, str]:
+        node = data.df_org_nodes.loc[int(params['node'])]
+        kpi = data.df_kpis.loc[params['kpi']]
+        kpi_filter = cfg.alert.filters.loc[int(params.get('filter', 0))]
+
+        def compute():
+            df_node = aggregator.filter_by_org_node(data.df_kpi_values, node)
+            df_filtered = aggregator.filter_by_kpi_filter(df_node, kpi_filter)
+            return aggregator.get_kpi_timeline(df_filtered, data.df_benchmarks, kpi)
+
+        return data.get_cached(('timeline', node.name, kpi.name, kpi_filter.name), compute)
+
+    def _get_participation(self, data: _Data, params: dict) -> Tuple[str, str]:
+        node = data.df_org_nodes.loc[int(params['node'])]
+
+        return data.get_cached(('participation', node.name),
+                               lambda: aggregator.get_participation_timelines(data.df_surveys, node))
+
+    def _get_alerts(self, data: _Data, params: dict) -> Tuple[str, str]:
+        node_ids = self._get_list(params, 'nodes', cfg.nodes.selected, int)
+        kpi_names = self._get_list(params, 'kpis', list(data.df_benchmarks.dropna(subset=['mean']).index))
+
+        return data.get_cached(('alerts', tuple(node_ids), tuple(kpi_names)), lambda: alert.get_alerts(
+            data.df_kpi_values, data.df_org_nodes.loc[node_ids], data.df_kpis.loc[kpi_names], data.df_benchmarks,
+            csv_path=None))
+
+    def _get_top_alerts(self, data: _Data, params: dict) -> Tuple[str, str]:
+        node_ids = self._get_list(params, 'nodes', cfg.nodes.selected, int)
+        kpi_names = self._get_list(params, 'kpis', list(data.df_benchmarks.dropna(subset=['mean']).index))
+        k = int(params.get('k', cfg.alert.top_k))
+        rank_by = params.get('rank_by', 'z_score')
+        weeks = int(params['weeks']) if 'weeks' in params else None
+
+        return data.get_cached(('top_alerts', tuple(node_ids), tuple(kpi_names), k, rank_by, weeks),
+                               lambda: alert.get_top_alerts(data.df_kpi_values, data.df_org_nodes.loc[node_ids],
+                                                            data.df_kpis.loc[kpi_names], data.df_benchmarks,
+                                                            k=k, rank_by=rank_by, weeks=weeks))
+
+
+class _AnalysisServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, df_benchmarks: pd.DataFrame = None):
+        super().__init__(address, _RequestHandler)
+        self.df_benchmarks = df_benchmarks
+        self.data = _Data(df_benchmarks)
+        self.stopped = threading.Event()
+
+    def refresh_periodically(self):
+        while not self.stopped.wait(cfg.server.refresh_minutes * 60):
+            # Requests keep being served from the old snapshot until the new one is loaded
+            try:
+                self.data = _Data(self.df_benchmarks)
+            except Exception:
+                _logger.exception('Refreshing data failed, serving the previous data until the next refresh')
+
+
+def serve(df_benchmarks: pd.DataFrame = None, port: int = None):
+    """
+    Runs the analysis server until interrupted.
+
+    Parameters
+    ----------
+    df_benchmarks   : KPI benchmarks, defaults to benchmarks measured from the kpi values
+    port            : Local port, defaults to cfg.server.port
+    """
+    port = cfg.server.port if port is None else port
+    server = _AnalysisServer((cfg.server.host, port), df_benchmarks)
+    refresher = threading.Thread(target=server.refresh_periodically, daemon=True)
+    refresher.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.stopped.set()
+        server.server_close()
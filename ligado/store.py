@@ -0,0 +1,156 @@
+# ----------------------------------------------------------------------------------------------------------------------
+# Precomputed KPI timeline store
+# ----------------------------------------------------------------------------------------------------------------------
+
+# All (org node, KPI, filter) timelines are exported into a single SQLite file, keyed like the cockpit deep links
+# (orgNodeID, kpiID, filter plugin and category). Every timeline is stored as a JSON string in pandas 'split' format,
+# so a web tier can look up and serve timelines without pandas.
+
+from ligado import config as cfg, aggregator
+import json
+import os
+import pandas as pd
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional
+
+_CREATE_TABLE = """
+    CREATE TABLE timelines (
+        orgNodeID INTEGER NOT NULL,
+        kpiID INTEGER NOT NULL,
+        filterPlugin TEXT NOT NULL,
+        filterCategory TEXT NOT NULL,
+        timeline TEXT NOT NULL,
+        PRIMARY KEY (orgNodeID, kpiID, filterPlugin, filterCategory)
+    ) WITHOUT ROWID"""
+
+
+def _get_filter_key(kpi_filter: pd.Series) -> tuple:
+    """
+    Returns the (plugin, category) key of a kpi filter, empty strings for no filter.
+    """
+    if kpi_filter['type'] == 'none':
+        return '', ''
+
+    return kpi_filter['plugin'], kpi_filter['category']
+
+
+def export_timelines(df_kpi_values: pd.DataFrame, org_nodes: pd.DataFrame, kpis: pd.DataFrame,
+                     df_benchmarks: pd.DataFrame, path: str = None) -> int:
+    """
+    Computes the timelines of all org nodes, KPIs and cfg.alert.filters and writes them into a SQLite file.
+    An existing file is replaced. Returns the number of exported timelines.
+    On Windows, the file cannot be replaced while a TimelineStore holds it open, close the stores before exporting.
+
+    Parameters
+    ----------
+    df_kpi_values   : Dataframe with kpi data
+    org_nodes       : Org nodes to export
+    kpis            : KPIs to export
+    df_benchmarks   : KPI benchmarks
+    path            : SQLite file path, defaults to cfg.store.path
+    """
+    path = cfg.store.path if path is None else path
+
+    rows = []
+    for node_id, node in org_nodes.iterrows():
+        df_node = aggregator.filter_by_org_node(df_kpi_values, node)
+        for _, kpi_filter in cfg.alert.filters.iterrows():
+            df_filtered = aggregator.filter_by_kpi_filter(df_node, kpi_filter)
+            plugin, category = _get_filter_key(kpi_filter)
+            for _, kpi in kpis.iterrows():
+                df_kpi_timeline = aggregator.get_kpi_timeline(df_filtered, df_benchmarks, kpi)
+                if df_kpi_timeline.empty:
+                    continue
+
+                timeline = df_kpi_timeline.to_json(orient='split', date_format='iso', date_unit='s')
+                rows.append((int(node_id), int(kpi['kpiID']), plugin, category, timeline))
+
+    # Write into a new file and move it into place, so readers never see a missing or incomplete table
+    path_tmp = '{}.tmp'.format(path)
+    if os.path.exists(path_tmp):
+        os.remove(path_tmp)
+    try:
+        connection = sqlite3.connect(path_tmp)
+        with connection:
+            connection.execute(_CREATE_TABLE)
+            connection.executemany('INSERT INTO timelines VALUES (?, ?, ?, ?, ?)', rows)
+        connection.close()
+        os.replace(path_tmp, path)
+    finally:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+
+    return len(rows)
+
+
+class TimelineStore:
+    """
+    Reads timelines from a file written by export_timelines. Keeps the connection open for fast keyed lookups and
+    reopens it when the file has been replaced by a new export.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = Path(cfg.store.path if path is None else path).resolve()
+        self.lock = threading.Lock()
+        self.file_id = None
+        self.connection = None
+        self._connect()
+
+    def _get_file_id(self) -> tuple:
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _connect(self):
+        file_id = self._get_file_id()
+        # Read-only, the web tier may share a connection between threads
+        # The previous connection is not closed explicitly, other threads may still read from it. It is closed once
+        # it is no longer referenced.
+        self.connection = sqlite3.connect(self.path.as_uri() + '?mode=ro', uri=True, check_same_thread=False)
+        self.file_id = file_id
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._get_file_id() != self.file_id:
+            with self.lock:
+                if self._get_file_id() != self.file_id:
+                    self._connect()
+
+        return self.connection
+
+    def get_timeline_json(self, org_node_id: int, kpi_id: int, plugin: str = '', category: str = '') -> Optional[str]:
+        """
+        Returns a timeline as JSON string in pandas 'split' format, or None if there is no such timeline.
+        """
+        row = self._get_connection().execute(
+            'SELECT timeline FROM timelines '
+            'WHERE orgNodeID = ? AND kpiID = ? AND filterPlugin = ? AND filterCategory = ?',
+            (org_node_id, kpi_id, plugin, category)).fetchone()
+
+        return None if row is None else row[0]
+
+    def get_timeline(self, org_node_id: int, kpi_id: int, plugin: str = '', category: str = '') -> Optional[dict]:
+        """
+        Returns a timeline as dict with 'columns', 'index' (dates) and 'data' keys, or None if there is no such
+        timeline.
+        """
+        timeline = self.get_timeline_json(org_node_id, kpi_id, plugin, category)
+
+        return None if timeline is None else json.loads(timeline)
+
+    def get_timeline_df(self, org_node_id: int, kpi_id: int, plugin: str = '', category: str = '') -> pd.DataFrame:
+        """
+        Returns a timeline dataframe like aggregator.get_kpi_timeline, empty if there is no such timeline.
+        """
+        timeline = self.get_timeline(org_node_id, kpi_id, plugin, category)
+        if timeline is None:
+            return pd.DataFrame()
+
+        df_kpi_timeline = pd.DataFrame(timeline['data'], index=pd.to_datetime(timeline['index']),
+                                       columns=timeline['columns'])
+        df_kpi_timeline.index.name = 'date'
+
+        return df_kpi_timeline
+
+    def close(self):
+        self.connection.close()